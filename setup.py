@@ -98,5 +98,6 @@ setup(
     classifiers=CLASSIFIERS,
     keywords=KEYWORDS,
     zip_safe=False,
-    install_requires=install_requires()
+    install_requires=install_requires(),
+    extras_require={'orjson': ['orjson']}
 )
@@ -14,13 +14,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import collections
+import ctypes
+import errno
+import ipaddress
 import json
+import logging
+import os
 import socket
+import sys
+import threading
 import time
 
 import requests
-import six
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 
 __author__ = 'Lynn Root'
@@ -34,46 +45,128 @@ __uri__ = 'https://github.com/spotify/shumway'
 FFWD_IP = '127.0.0.1'
 FFWD_PORT = 19000
 GIGA_UNIT = 1E9
+UDP_SNDBUF_SIZE = 4 * 1024 * 1024
+ASYNC_QUEUE_SIZE = 1024
+
+logger = logging.getLogger(__name__)
+
+
+def _stdlib_json_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _orjson_default(obj):
+    # orjson only accepts exact floats and ints; numpy.float64 and other
+    # subclasses are serialized as the plain number, as json does.
+    if isinstance(obj, float):
+        return float(obj)
+    if isinstance(obj, int):
+        return int(obj)
+    raise TypeError
+
+
+if orjson is not None:
+    def _json_dumps(obj):
+        try:
+            return orjson.dumps(obj, default=_orjson_default,
+                                option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Anything else orjson refuses but json accepts, such as
+            # integers beyond 64 bits.
+            return _stdlib_json_dumps(obj)
+else:
+    _json_dumps = _stdlib_json_dumps
+
+# Shared by every meter created without tags; a tuple can't be mutated.
+_EMPTY_TAGS = ()
+
+# Stands in for a metric's value when pre-serializing the rest of it.
+_VALUE_PLACEHOLDER = '\x00shumway-value\x00'
+_ENCODED_VALUE_PLACEHOLDER = _json_dumps(_VALUE_PLACEHOLDER)
 
 
 class Meter(object):
-    """A single metric with updateable value (no local aggregation)."""
+    """A single metric with updateable value (no local aggregation).
+
+    Meters created without tags share one empty tuple as their tags.
+    """
+    __slots__ = ('value', '_key', '_attributes', '_resources', '_tags',
+                 '_template', '_prefix_bytes', '_suffix_bytes')
+
     def __init__(self, what, key, attributes=None,
                  resources=None, tags=None, value=0):
         self.value = value
-        self.key = key
+        self._key = key
         self._attributes = {'what': what}
         if attributes is not None:
             self._attributes.update(attributes)
-        self._resources = dict()
-        if resources is not None:
-            self._resources.update(resources)
+        self._resources = {} if resources is None else dict(resources)
         if tags is None:
-            self._tags = []
+            self._tags = _EMPTY_TAGS
         else:
             self._tags = tags
-
-    def update(self, value):
-        self.value = value
-
-    def as_dict(self):
-        """Create a map of data"""
-        return {
-            'key': self.key,
+        self._template = {
+            'key': key,
             'attributes': self._attributes,
-            'value': self.value,
+            'value': value,
             'type': 'metric',
             'tags': self._tags,
             'resources': self._resources
         }
+        self._prefix_bytes = None
+        self._suffix_bytes = None
+
+    @property
+    def key(self):
+        return self._key
+
+    @key.setter
+    def key(self, key):
+        self._key = key
+        self._template['key'] = key
+        # to_bytes() has the old key serialized into its cached prefix.
+        self._prefix_bytes = None
+
+    def update(self, value):
+        self.value = value
+
+    def as_dict(self):
+        """Create a map of data
+
+        The same map is reused and refreshed with the current value on
+        every call; copy it if you need to keep a snapshot.
+        """
+        template = self._template
+        template['value'] = self.value
+        return template
 
     def flush(self, func):
         """Create a map of data and pass it to another function"""
         func(self.as_dict())
 
+    def _rebuild_cache(self):
+        """Serialize everything but the value, which is all that changes
+        between flushes."""
+        data = dict(self.as_dict(), value=_VALUE_PLACEHOLDER)
+        self._prefix_bytes, _, self._suffix_bytes = _json_dumps(
+            data).partition(_ENCODED_VALUE_PLACEHOLDER)
+
+    def to_bytes(self):
+        """Serialize the map of data to JSON bytes
+
+        Everything but the value is serialized once and reused. Setting
+        key rebuilds it, but changes made to attributes, resources or
+        tags in place after the first call are not picked up.
+        """
+        if self._prefix_bytes is None:
+            self._rebuild_cache()
+        return (self._prefix_bytes + _json_dumps(self.value) +
+                self._suffix_bytes)
+
 
 class Counter(Meter):
     """Keep track of an incrementally increasing metric."""
+    __slots__ = ()
 
     def incr(self, value=1):
         self.update(self.value + value)
@@ -81,6 +174,8 @@ class Counter(Meter):
 
 class Timer(Meter):
     """Time the duration of running something"""
+    __slots__ = ('_start',)
+
     def __init__(self, what, key, attributes=None, resources=None, tags=None):
         Meter.__init__(self, what, key, attributes, resources, tags)
         self._attributes.update({'unit': 'ns'})
@@ -88,18 +183,30 @@ class Timer(Meter):
         self.value = None
 
     def __enter__(self):
-        self._start = time.time()
+        self._start = time.monotonic_ns()
         return self
 
     def __exit__(self, *args):
-        self.update((time.time() - self._start) * GIGA_UNIT)
+        self.update(time.monotonic_ns() - self._start)
 
 
 class MetricRelay(object):
-    """Create and send metrics"""
+    """Create and send metrics
+
+    default_attributes and default_resources are shallow-copied, so
+    their values are shared with the mappings passed in.
+
+    expected_metrics is an advanced tuning knob: counters named in it
+    are created up front, so the metrics map is built to its final size
+    at once instead of growing while the application warms up. They are
+    flushed with a value of 0 until incremented.
+    """
     def __init__(self, default_key, ffwd_host=None, ffwd_ip=None,
                  ffwd_port=FFWD_PORT, ffwd_path=None, default_attributes=None,
-                 default_resources=None, use_http=False):
+                 default_resources=None, use_http=False,
+                 max_payload_size=None, sndbuf_size=UDP_SNDBUF_SIZE,
+                 async_send=False, async_queue_size=ASYNC_QUEUE_SIZE,
+                 expected_metrics=None):
         if ffwd_host is not None and ffwd_ip is not None:
             raise ValueError('Both "ffwd_host" and "ffwd_ip are set, but only '
                              'one of them is allowed to be set at a time')
@@ -110,12 +217,23 @@ class MetricRelay(object):
         else:
             host = FFWD_IP
 
-        self._metrics = {}
         self._default_key = default_key
-        self._default_attributes = copy.deepcopy(default_attributes)
-        self._default_resources = copy.deepcopy(default_resources)
-        self._sender = _HTTPSender(ffwd_host, ffwd_port, ffwd_path) \
-            if use_http else _UDPSender(host, ffwd_port)
+        self._default_attributes = None if default_attributes is None \
+            else dict(default_attributes)
+        self._default_resources = None if default_resources is None \
+            else dict(default_resources)
+        if expected_metrics is None:
+            self._metrics = {}
+        else:
+            self._metrics = {m: self._new_counter(m)
+                             for m in expected_metrics}
+        if use_http:
+            self._sender = _HTTPSender(ffwd_host, ffwd_port, ffwd_path)
+        else:
+            self._sender = _UDPSender(host, ffwd_port, max_payload_size,
+                                      sndbuf_size)
+        if async_send:
+            self._sender = _AsyncSender(self._sender, async_queue_size)
 
     def emit(self, metric, value, attributes=None, resources=None, tags=None):
         """Emit one-time metric that does not need to be stored."""
@@ -126,20 +244,22 @@ class MetricRelay(object):
 
     def incr(self, metric, value=1):
         """Increment a metric, creates it if new"""
-        if metric in self._metrics:
-            counter = self._metrics[metric]
-        else:
-            counter = Counter(metric, key=self._default_key,
-                              attributes=self._default_attributes,
-                              resources=self._default_resources)
+        counter = self._metrics.get(metric)
+        if counter is None:
+            counter = self._new_counter(metric)
             self._metrics[metric] = counter
-        counter.incr(value)
+        # Same as counter.incr(value), without the two method calls.
+        counter.value += value
+
+    def _new_counter(self, metric):
+        return Counter(metric, key=self._default_key,
+                       attributes=self._default_attributes,
+                       resources=self._default_resources)
 
     def timer(self, metric):
-        timer_metric = 'timer-{}'.format(metric)
-        if timer_metric in self._metrics:
-            timer = self._metrics[timer_metric]
-        else:
+        timer_metric = f'timer-{metric}'
+        timer = self._metrics.get(timer_metric)
+        if timer is None:
             timer = Timer(metric, key=self._default_key,
                           attributes=self._default_attributes,
                           resources=self._default_resources)
@@ -150,7 +270,7 @@ class MetricRelay(object):
         self._metrics[metric] = counter
 
     def set_timer(self, metric, timer):
-        self._metrics['timer-{}'.format(metric)] = timer
+        self._metrics[f'timer-{metric}'] = timer
 
     def flush(self):
         """Send all metrics to FFWD"""
@@ -160,23 +280,174 @@ class MetricRelay(object):
         """Send a metric to FFWD."""
         self._sender.send_single(metric)
 
+    def close(self):
+        """Finish any pending sends and release the connection to FFWD
+
+        No metrics can be sent afterwards; with async_send, flush() and
+        emit() raise RuntimeError once the relay is closed.
+        """
+        self._sender.close()
+
+    @property
+    def dropped(self):
+        """Number of sends discarded because the async queue was full"""
+        return getattr(self._sender, 'dropped', 0)
+
     def __contains__(self, metric):
         return metric in self._metrics
 
 
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """Look up sendmmsg(2) in libc; only available on Linux."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        # The process already has libc loaded; find_library() would
+        # spawn ldconfig just to locate it.
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                         ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def _is_ipv4_address(host):
+    try:
+        ipaddress.IPv4Address(host)
+    except ValueError:
+        return False
+    return True
+
+
 class _UDPSender:
-    def __init__(self, ffwd_host, ffwd_port):
+    def __init__(self, ffwd_host, ffwd_port, max_payload_size=None,
+                 sndbuf_size=UDP_SNDBUF_SIZE):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if sndbuf_size is not None:
+            try:
+                self._sock.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf_size)
+            except OSError:
+                # Some platforms refuse buffers above a system-wide cap;
+                # keep the default buffer rather than failing.
+                pass
         self._ffwd_address = (ffwd_host, ffwd_port)
+        self._max_payload_size = max_payload_size
+        # A connected socket skips the per-datagram address lookup. Only
+        # connect to IP addresses: connecting to a hostname would resolve
+        # it once and pin that address, where sendto() re-resolves it.
+        self._connected = False
+        if _is_ipv4_address(ffwd_host):
+            try:
+                self._sock.connect(self._ffwd_address)
+                self._connected = True
+            except OSError:
+                pass
 
     def send(self, metrics):
-        for metric in six.itervalues(metrics):
-            self._sock.sendto(
-                json.dumps(
-                    metric.as_dict()).encode('utf-8'), self._ffwd_address)
+        datagrams = list(self._datagrams(metrics.values()))
+        if self._connected and _sendmmsg is not None and len(datagrams) > 1:
+            self._send_many(datagrams)
+            return
+        for datagram in datagrams:
+            self._send_datagram(datagram)
+
+    def _send_datagram(self, datagram):
+        if not self._connected:
+            self._sock.sendto(datagram, self._ffwd_address)
+            return
+        try:
+            self._sock.send(datagram)
+        except ConnectionRefusedError:
+            # An earlier datagram found nobody listening. Unconnected
+            # sockets never report that, so drop this one silently too.
+            pass
+
+    def _send_many(self, datagrams):
+        """Send all datagrams with a single sendmmsg(2) call."""
+        count = len(datagrams)
+        iovecs = (_IOVec * count)()
+        msgs = (_MMsgHdr * count)()
+        for i, datagram in enumerate(datagrams):
+            # Point straight at the bytes objects, which `datagrams`
+            # keeps alive until the call returns.
+            iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(datagram),
+                                             ctypes.c_void_p)
+            iovecs[i].iov_len = len(datagram)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(iovecs[i])
+            hdr.msg_iovlen = 1
+
+        fd = self._sock.fileno()
+        sent = 0
+        while sent < count:
+            # sendmmsg may stop short; carry on from the first unsent one.
+            result = _sendmmsg(
+                fd, ctypes.addressof(msgs) + sent * ctypes.sizeof(_MMsgHdr),
+                count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err == errno.ECONNREFUSED:
+                    # As in _send_datagram; skip the unsent datagram.
+                    sent += 1
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += result
+
+    def _datagrams(self, metrics):
+        """Encode metrics, packing them newline-separated into datagrams
+        of at most max_payload_size bytes (one metric each if unset)."""
+        if self._max_payload_size is None:
+            for metric in metrics:
+                yield metric.to_bytes()
+            return
+
+        buf = bytearray()
+        for metric in metrics:
+            encoded = metric.to_bytes()
+            if buf and len(buf) + 1 + len(encoded) > self._max_payload_size:
+                yield bytes(buf)
+                buf = bytearray()
+            if buf:
+                buf += b'\n'
+            buf += encoded
+        if buf:
+            yield bytes(buf)
 
     def send_single(self, metric):
-        self.send({metric.key: metric})
+        # One-off metrics are sent once, so skip building their cache.
+        self._send_datagram(_json_dumps(metric.as_dict()))
+
+    def close(self):
+        self._sock.close()
 
 
 class _HTTPSender:
@@ -189,26 +460,104 @@ class _HTTPSender:
         self._ffwd_url = "{}:{}".format(ffwd_host, ffwd_port)
         self._ffwd_url = self._ffwd_url + ffwd_path \
             if ffwd_path is not None else self._ffwd_url
+        self._session = requests.Session()
 
     def send(self, metrics):
-        metrics_resolved = [self._convert_metric_to_http_payload(m)
-                            for m in six.itervalues(metrics)]
-        metrics_payload = {
-            'points': metrics_resolved
-        }
-
-        requests.post(self._ffwd_url, json=metrics_payload).raise_for_status()
+        timestamp = int(time.time() * 1000.0)
+        convert = self._convert_metric_to_http_payload
+        self._post([convert(m, timestamp) for m in metrics.values()])
 
     def send_single(self, metric):
-        self.send({metric.key: metric})
+        timestamp = int(time.time() * 1000.0)
+        self._post([self._convert_metric_to_http_payload(metric, timestamp)])
 
-    def _convert_metric_to_http_payload(self, metric):
-        metrics_as_dict = metric.as_dict()
+    def close(self):
+        self._session.close()
 
+    def _post(self, points):
+        self._session.post(self._ffwd_url,
+                           data=_json_dumps({'points': points}),
+                           headers={'Content-Type': 'application/json'}
+                           ).raise_for_status()
+
+    def _convert_metric_to_http_payload(self, metric, timestamp):
         return {
-            'key': metrics_as_dict['key'],
-            'tags': metrics_as_dict['attributes'],
-            'resource': metrics_as_dict['resources'],
-            'value': metrics_as_dict['value'],
-            'timestamp': int(time.time() * 1000.0),
+            'key': metric.key,
+            'tags': metric._attributes,
+            'resource': metric._resources,
+            'value': metric.value,
+            'timestamp': timestamp,
         }
+
+
+# Returned by _AsyncSender._pop when the consumer thread should exit.
+_STOP = object()
+
+
+class _AsyncSender:
+    """Send metrics from a background thread instead of the caller's.
+
+    Pending sends wait in a bounded deque; once it is full the oldest
+    one is discarded and counted in `dropped`.
+    """
+    def __init__(self, sender, queue_size):
+        self._sender = sender
+        self._queue = collections.deque(maxlen=queue_size)
+        # Guards the queue, so a full queue and a consumer pop can't be
+        # confused, and orders sends against close().
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._closed = False
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='shumway-sender', daemon=True)
+        self._thread.start()
+
+    def send(self, metrics):
+        # Copy the mapping so the caller may keep adding metrics to it;
+        # values are read when the metrics are actually sent.
+        self._put(self._sender.send, dict(metrics))
+
+    def send_single(self, metric):
+        self._put(self._sender.send_single, metric)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._pending.set()
+        self._thread.join()
+        self._sender.close()
+
+    def _put(self, send, arg):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Cannot send metrics after close()')
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((send, arg))
+        self._pending.set()
+
+    def _pop(self):
+        """Return the next pending send, None if there is none yet, or
+        _STOP once closed with nothing left to send."""
+        with self._lock:
+            if self._queue:
+                return self._queue.popleft()
+            if self._closed:
+                return _STOP
+            return None
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            item = self._pop()
+            while item is not None:
+                if item is _STOP:
+                    return
+                send, arg = item
+                try:
+                    send(arg)
+                except Exception:
+                    logger.exception('Failed to send metrics to FFWD')
+                item = self._pop()
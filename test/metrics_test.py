@@ -17,9 +17,9 @@
 import collections
 import json
 import socket
+import threading
 
 import mock
-import six
 import unittest2
 
 import shumway
@@ -43,7 +43,7 @@ def patcher(classes, autospec=True):
 
 def list_of_mocks(target, quantity):
     mocks = []
-    for _ in six.moves.xrange(quantity):
+    for _ in range(quantity):
         class_ = mock.patch(target, autospec=True)
         instance = class_.start()
         mocks.append(instance)
@@ -52,17 +52,17 @@ def list_of_mocks(target, quantity):
 
 class TimerTest(unittest2.TestCase):
 
-    @mock.patch('shumway.time.time')
-    def test_timer(self, time):
-        time.side_effect = [0, 1]
+    @mock.patch('shumway.time.monotonic_ns')
+    def test_timer(self, monotonic_ns):
+        monotonic_ns.side_effect = [0, 1000000000]
         timer = shumway.Timer('timer', 'key', {'test': 'test'})
         with timer:
             pass
-        self.assertEqual(timer.value, 1000000000.0)
+        self.assertEqual(timer.value, 1000000000)
 
-    @mock.patch('shumway.time.time')
-    def test_timer_tags(self, time):
-        time.side_effect = [0, 1]
+    @mock.patch('shumway.time.monotonic_ns')
+    def test_timer_tags(self, monotonic_ns):
+        monotonic_ns.side_effect = [0, 1000000000]
         timer = shumway.Timer('timer',
                               'key',
                               {'test': 'test'},
@@ -70,16 +70,21 @@ class TimerTest(unittest2.TestCase):
                               ['test'])
         with timer:
             pass
-        self.assertEqual(timer.value, 1000000000.0)
+        self.assertEqual(timer.value, 1000000000)
 
-    @mock.patch('shumway.time.time')
-    def test_flush(self, time):
+    def test_attributes(self):
+        timer = shumway.Timer('timer', 'key', {'test': 'test'})
+        self.assertEqual({'what': 'timer', 'test': 'test', 'unit': 'ns'},
+                         timer.as_dict()['attributes'])
+
+    @mock.patch('shumway.time.monotonic_ns')
+    def test_flush(self, monotonic_ns):
         send_metric = mock.Mock()
-        time.side_effect = [0, 1]
+        monotonic_ns.side_effect = [0, 1000000000]
         timer = shumway.Timer('timer', 'key')
         timer.flush(send_metric)
         send_metric.assert_called_once_with({
-            'tags': [],
+            'tags': (),
             'value': None,
             'attributes': {'what': 'timer', 'unit': 'ns'},
             'resources': {},
@@ -114,7 +119,7 @@ class CounterTest(unittest2.TestCase):
             'attributes': {'what': 'test'},
             'resources': {},
             'value': 1,
-            'tags': [],
+            'tags': (),
             'type': 'metric'})
 
     def test_flush_with_attributes(self):
@@ -127,7 +132,7 @@ class CounterTest(unittest2.TestCase):
             'attributes': {'what': 'test', 'k': 'v'},
             'resources': {},
             'value': 1,
-            'tags': [],
+            'tags': (),
             'type': 'metric'})
 
     def test_flush_with_tags(self):
@@ -154,9 +159,64 @@ class CounterTest(unittest2.TestCase):
             'attributes': {'what': 'test'},
             'value': 1,
             'type': 'metric',
-            'tags': [],
+            'tags': (),
             'resources': {'res1': 'value'}})
 
+    def test_as_dict_reflects_current_value(self):
+        C = shumway.Counter('test', 'key')
+        C.as_dict()
+        C.incr(2)
+        self.assertEqual(C.as_dict()['value'], 2)
+
+    def test_as_dict_reflects_key_change(self):
+        C = shumway.Counter('test', 'key')
+        C.as_dict()
+        C.key = 'other-key'
+        self.assertEqual('other-key', C.key)
+        self.assertEqual('other-key', C.as_dict()['key'])
+
+    def test_has_no_instance_dict(self):
+        C = shumway.Counter('test', 'key')
+        self.assertFalse(hasattr(C, '__dict__'))
+
+    def test_to_bytes_after_incr(self):
+        C = shumway.Counter('test', 'key', attributes={'k': 'v'},
+                            tags=['test::tag'])
+        C.to_bytes()
+        C.incr(2.5)
+        self.assertEqual(shumway._json_dumps(C.as_dict()), C.to_bytes())
+
+    def test_to_bytes_with_number_subclasses(self):
+        class Float(float):
+            pass
+
+        C = shumway.Counter('test', 'key', value=Float(1.5))
+        self.assertEqual(1.5, json.loads(C.to_bytes())['value'])
+        C.update(2 ** 70)
+        self.assertEqual(2 ** 70, json.loads(C.to_bytes())['value'])
+
+    def test_to_bytes_with_non_str_attribute_keys(self):
+        C = shumway.Counter('test', 'key', attributes={1: 'v'})
+        self.assertEqual({'what': 'test', '1': 'v'},
+                         json.loads(C.to_bytes())['attributes'])
+
+    def test_share_empty_tags(self):
+        C1 = shumway.Counter('test', 'key')
+        C2 = shumway.Counter('test-2', 'key')
+        self.assertIs(C1._tags, C2._tags)
+
+    def test_resources_are_per_meter(self):
+        C1 = shumway.Counter('test', 'key')
+        C2 = shumway.Counter('test-2', 'key')
+        C1.as_dict()['resources']['host'] = 'a'
+        self.assertEqual({}, C2.as_dict()['resources'])
+
+    def test_to_bytes_reflects_key_change(self):
+        C = shumway.Counter('test', 'key')
+        C.to_bytes()
+        C.key = 'other-key'
+        self.assertEqual('other-key', json.loads(C.to_bytes())['key'])
+
     def test_intial_value(self):
         C = shumway.Counter('test', 'key', value=4)
         C.incr(4)
@@ -167,10 +227,36 @@ class MetricRelayTest(unittest2.TestCase):
     def setUp(self):
         self.patched = patcher(
             ['shumway.socket.socket', 'shumway.requests'])
+        # sendmmsg(2) needs a real socket; UDPSenderTest covers it.
+        self.sendmmsg_patcher = mock.patch('shumway._sendmmsg', None)
+        self.sendmmsg_patcher.start()
 
     def tearDown(self):
-        for patched in six.itervalues(self.patched):
+        for patched in self.patched.values():
             patched.patcher.stop()
+        self.sendmmsg_patcher.stop()
+
+    def _assert_sent(self, sock, expected):
+        # Compare decoded JSON, so the test doesn't depend on how the
+        # serializer in use formats its output.
+        sock.send.assert_called_once()
+        self.assertEqual(expected, json.loads(sock.send.call_args[0][0]))
+
+    def test_emit_float_subclass(self):
+        class Float(float):
+            pass
+
+        sock = self.patched[
+            'shumway.socket.socket'].mock_instance
+        mr = shumway.MetricRelay('key')
+        mr.emit('one_time_metric', Float(1.5))
+
+        self._assert_sent(sock, {'key': 'key',
+                                 'attributes': {'what': 'one_time_metric'},
+                                 'value': 1.5,
+                                 'type': 'metric',
+                                 'tags': [],
+                                 'resources': {}})
 
     def test_emit(self):
         sock = self.patched[
@@ -191,8 +277,7 @@ class MetricRelayTest(unittest2.TestCase):
                   'type': 'metric',
                   'tags': ['cool-metric'],
                   'resources': {'res1': 'value'}}
-        sock.sendto.assert_called_once_with(
-            json.dumps(metric).encode('utf-8'), mr._sender._ffwd_address)
+        self._assert_sent(sock, metric)
 
     def test_incr_and_send(self):
         sock = self.patched[
@@ -209,8 +294,7 @@ class MetricRelayTest(unittest2.TestCase):
                   'type': 'metric',
                   'tags': [],
                   'resources': {}}
-        sock.sendto.assert_called_once_with(
-            json.dumps(metric).encode('utf-8'), mr._sender._ffwd_address)
+        self._assert_sent(sock, metric)
 
     def test_incr_and_send_with_default_attributes(self):
         sock = self.patched[
@@ -228,14 +312,69 @@ class MetricRelayTest(unittest2.TestCase):
                   'type': 'metric',
                   'tags': [],
                   'resources': {}}
-        sock.sendto.assert_called_once_with(
-            json.dumps(metric).encode('utf-8'), mr._sender._ffwd_address)
+        self._assert_sent(sock, metric)
+
+    def test_batch_metrics_into_one_datagram(self):
+        sock = self.patched[
+            'shumway.socket.socket'].mock_instance
+
+        mr = shumway.MetricRelay('key', max_payload_size=1400)
+        mr.incr('foo')
+        mr.incr('bar', 2)
+        mr.flush()
+
+        metrics = [{'key': 'key',
+                    'attributes': {'what': 'foo'},
+                    'value': 1,
+                    'type': 'metric',
+                    'tags': [],
+                    'resources': {}},
+                   {'key': 'key',
+                    'attributes': {'what': 'bar'},
+                    'value': 2,
+                    'type': 'metric',
+                    'tags': [],
+                    'resources': {}}]
+        sock.send.assert_called_once_with(
+            b'\n'.join(shumway._json_dumps(m) for m in metrics))
+
+    def test_batch_splits_at_max_payload_size(self):
+        sock = self.patched[
+            'shumway.socket.socket'].mock_instance
+
+        metric = {'key': 'key',
+                  'attributes': {'what': 'test'},
+                  'value': 1,
+                  'type': 'metric',
+                  'tags': [],
+                  'resources': {}}
+        encoded = shumway._json_dumps(metric)
+
+        mr = shumway.MetricRelay('key', max_payload_size=len(encoded) * 2 + 1)
+        for name in ('test', 'test-2', 'test-3'):
+            mr.set_counter(name, shumway.Counter('test', 'key', value=1))
+        mr.flush()
+
+        self.assertEqual(
+            [mock.call(encoded + b'\n' + encoded), mock.call(encoded)],
+            sock.send.call_args_list)
+
+    def test_default_attributes_are_merged_per_metric(self):
+        mr = shumway.MetricRelay('key', default_attributes=dict(foo='bar'))
+        mr.incr('foo')
+        mr.timer('bar')
+
+        self.assertEqual({'what': 'foo', 'foo': 'bar'},
+                         mr._metrics['foo'].as_dict()['attributes'])
+        self.assertEqual({'what': 'bar', 'foo': 'bar', 'unit': 'ns'},
+                         mr._metrics['timer-bar'].as_dict()['attributes'])
+        self.assertEqual({'foo': 'bar'}, mr._default_attributes)
 
     @mock.patch('shumway.time', autospec=True)
     def test_send_via_http(self, time):
         time.time.return_value = 1
-        requests = self.patched[
-            'shumway.requests'].mock_object
+        session = self.patched[
+            'shumway.requests'].mock_object.Session.return_value
 
         mr = shumway.MetricRelay('key',
                                  ffwd_host="http://metrics.com",
@@ -255,8 +394,83 @@ class MetricRelayTest(unittest2.TestCase):
              }
         ]}
 
-        requests.post.assert_called_once_with(
-            "http://metrics.com:8080/v1/api", json=metric_payload)
+        session.post.assert_called_once_with(
+            "http://metrics.com:8080/v1/api",
+            data=shumway._json_dumps(metric_payload),
+            headers={'Content-Type': 'application/json'})
+
+    @mock.patch('shumway.time', autospec=True)
+    def test_send_via_http_reads_clock_once(self, time):
+        time.time.side_effect = [1, 2]
+        session = self.patched[
+            'shumway.requests'].mock_object.Session.return_value
+
+        mr = shumway.MetricRelay('key',
+                                 ffwd_host="http://metrics.com",
+                                 use_http=True)
+        mr.incr('foo')
+        mr.incr('bar')
+        mr.flush()
+
+        time.time.assert_called_once_with()
+        payload = json.loads(session.post.call_args[1]['data'])
+        self.assertEqual([1000, 1000],
+                         [p['timestamp'] for p in payload['points']])
+
+    def test_send_via_http_with_default_attributes(self):
+        session = self.patched[
+            'shumway.requests'].mock_object.Session.return_value
+
+        mr = shumway.MetricRelay('key',
+                                 ffwd_host="http://metrics.com",
+                                 default_attributes=dict(foo='bar'),
+                                 default_resources=dict(res1='value'),
+                                 use_http=True)
+        mr.incr('test')
+        mr.flush()
+
+        payload = json.loads(session.post.call_args[1]['data'])
+        self.assertEqual({'what': 'test', 'foo': 'bar'},
+                         payload['points'][0]['tags'])
+        self.assertEqual({'res1': 'value'},
+                         payload['points'][0]['resource'])
+
+    @mock.patch('shumway.time', autospec=True)
+    def test_emit_via_http(self, time):
+        time.time.return_value = 1
+        session = self.patched[
+            'shumway.requests'].mock_object.Session.return_value
+
+        mr = shumway.MetricRelay('key',
+                                 ffwd_host="http://metrics.com",
+                                 use_http=True)
+        mr.emit('one_time_metric', 22, resources={'res1': 'value'})
+
+        metric_payload = {'points': [
+            {'key': 'key',
+             'tags': {'what': 'one_time_metric'},
+             'resource': {'res1': 'value'},
+             'value': 22,
+             'timestamp': 1000
+             }
+        ]}
+        session.post.assert_called_once_with(
+            "http://metrics.com:19000",
+            data=shumway._json_dumps(metric_payload),
+            headers={'Content-Type': 'application/json'})
+
+    def test_send_via_http_reuses_session(self):
+        requests = self.patched['shumway.requests'].mock_object
+
+        mr = shumway.MetricRelay('key',
+                                 ffwd_host="http://metrics.com",
+                                 use_http=True)
+        mr.incr('test')
+        mr.flush()
+        mr.flush()
+
+        requests.Session.assert_called_once_with()
+        self.assertEqual(2, requests.Session.return_value.post.call_count)
 
     def test_custom_counter(self):
         sock = self.patched[
@@ -277,8 +491,7 @@ class MetricRelayTest(unittest2.TestCase):
                   'type': 'metric',
                   'tags': ['foo::bar'],
                   'resources': {}}
-        sock.sendto.assert_called_once_with(
-            json.dumps(metric).encode('utf-8'), mr._sender._ffwd_address)
+        self._assert_sent(sock, metric)
 
     @mock.patch('shumway.Timer', autospec=True)
     def test_timer(self, timer_init):
@@ -292,7 +505,7 @@ class MetricRelayTest(unittest2.TestCase):
 
         timer_init.assert_called_once_with('foo-timer', key='key',
                                            attributes=None, resources=None)
-        sock.sendto.assert_called_once()
+        sock.send.assert_called_once()
 
     @mock.patch('shumway.Timer', autospec=True)
     def test_timer_with_default_attributes(self, timer_init):
@@ -307,7 +520,7 @@ class MetricRelayTest(unittest2.TestCase):
 
         timer_init.assert_called_once_with('foo-timer', key='key',
                                            attributes=attrs, resources=None)
-        sock.sendto.assert_called_once()
+        sock.send.assert_called_once()
 
     @mock.patch('shumway.Timer', autospec=True)
     def test_getting_timer_twice(self, timer_init):
@@ -324,7 +537,7 @@ class MetricRelayTest(unittest2.TestCase):
         self.assertEqual(timer, same_timer)
         timer_init.assert_called_once_with('foo-timer', key='key',
                                            attributes=None, resources=None)
-        sock.sendto.assert_called_once()
+        sock.send.assert_called_once()
 
     def test_custom_timer(self):
         sock = self.patched[
@@ -337,7 +550,7 @@ class MetricRelayTest(unittest2.TestCase):
         mr.set_timer('key', timer)
         mr.flush()
 
-        sock.sendto.assert_called_once()
+        sock.send.assert_called_once()
 
     def test_creates_UDP_socket(self):
         sock = self.patched['shumway.socket.socket'].mock_object
@@ -348,8 +561,260 @@ class MetricRelayTest(unittest2.TestCase):
 
         sock.assert_called_once_with(socket.AF_INET, socket.SOCK_DGRAM)
 
+    def test_connects_UDP_socket(self):
+        sock = self.patched['shumway.socket.socket'].mock_instance
+
+        mr = shumway.MetricRelay('key', ffwd_ip='10.99.0.1', ffwd_port=19001)
+
+        sock.connect.assert_called_once_with(('10.99.0.1', 19001))
+        self.assertEqual(('10.99.0.1', 19001), mr._sender._ffwd_address)
+
+    def test_sends_unconnected_if_connect_fails(self):
+        sock = self.patched['shumway.socket.socket'].mock_instance
+        sock.connect.side_effect = OSError
+
+        mr = shumway.MetricRelay('key', ffwd_ip='10.99.0.1')
+        mr.incr('test')
+        mr.flush()
+
+        sock.send.assert_not_called()
+        sock.sendto.assert_called_once_with(mock.ANY, ('10.99.0.1', 19000))
+
+    def test_does_not_connect_to_hostname(self):
+        sock = self.patched['shumway.socket.socket'].mock_instance
+
+        mr = shumway.MetricRelay('key', ffwd_host='ffwd.example.com')
+        mr.incr('test')
+        mr.flush()
+
+        sock.connect.assert_not_called()
+        sock.send.assert_not_called()
+        sock.sendto.assert_called_once_with(mock.ANY,
+                                            ('ffwd.example.com', 19000))
+
+    def test_sets_UDP_send_buffer_size(self):
+        sock = self.patched['shumway.socket.socket'].mock_instance
+
+        shumway.MetricRelay('key', sndbuf_size=1024)
+
+        sock.setsockopt.assert_called_once_with(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, 1024)
+
+    def test_ignores_refused_UDP_send_buffer_size(self):
+        sock = self.patched['shumway.socket.socket'].mock_instance
+        sock.setsockopt.side_effect = OSError
+
+        mr = shumway.MetricRelay('key')
+        mr.incr('test')
+        mr.flush()
+
+        sock.send.assert_called_once()
+
+    def test_flush_after_key_change(self):
+        sock = self.patched[
+            'shumway.socket.socket'].mock_instance
+
+        mr = shumway.MetricRelay('key')
+        mr.incr('test')
+        mr.flush()
+        mr._metrics['test'].key = 'other-key'
+        sock.send.reset_mock()
+        mr.flush()
+
+        self._assert_sent(sock, {'key': 'other-key',
+                                 'attributes': {'what': 'test'},
+                                 'value': 1,
+                                 'type': 'metric',
+                                 'tags': [],
+                                 'resources': {}})
+
+    def test_close(self):
+        sock = self.patched['shumway.socket.socket'].mock_instance
+
+        mr = shumway.MetricRelay('key')
+        mr.close()
+
+        sock.close.assert_called_once_with()
+
+    def test_async_send(self):
+        sock = self.patched[
+            'shumway.socket.socket'].mock_instance
+
+        mr = shumway.MetricRelay('key', async_send=True)
+        mr.incr('test')
+        mr.flush()
+        mr.close()
+
+        metric = {'key': 'key',
+                  'attributes': {'what': 'test'},
+                  'value': 1,
+                  'type': 'metric',
+                  'tags': [],
+                  'resources': {}}
+        self._assert_sent(sock, metric)
+        sock.close.assert_called_once_with()
+        self.assertEqual(0, mr.dropped)
+
+    def test_expected_metrics(self):
+        sock = self.patched[
+            'shumway.socket.socket'].mock_instance
+
+        mr = shumway.MetricRelay('key', expected_metrics=['test'])
+        self.assertIn('test', mr)
+        mr.flush()
+
+        metric = {'key': 'key',
+                  'attributes': {'what': 'test'},
+                  'value': 0,
+                  'type': 'metric',
+                  'tags': [],
+                  'resources': {}}
+        self._assert_sent(sock, metric)
+
     def test_in_operator(self):
         mr = shumway.MetricRelay('key')
         self.assertNotIn('foo', mr)
         mr.incr('foo')
         self.assertIn('foo', mr)
+
+
+class UDPSenderTest(unittest2.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+
+    def tearDown(self):
+        self.receiver.close()
+
+    def _receive(self, count):
+        return [self.receiver.recv(65535) for _ in range(count)]
+
+    @unittest2.skipIf(shumway._sendmmsg is None, 'sendmmsg is unavailable')
+    def test_send_many_datagrams(self):
+        sender = shumway._UDPSender(*self.receiver.getsockname())
+        metrics = {}
+        for name in ('foo', 'bar', 'baz'):
+            metrics[name] = shumway.Counter(name, 'key', value=1)
+
+        sender.send(metrics)
+
+        self.assertEqual([m.to_bytes() for m in metrics.values()],
+                         self._receive(len(metrics)))
+
+    def test_ignores_refused_datagrams(self):
+        address = self.receiver.getsockname()
+        self.receiver.close()
+        sender = shumway._UDPSender(*address)
+        metrics = {'foo': shumway.Counter('foo', 'key')}
+
+        # The first datagram is refused by the kernel, which then makes
+        # the connected socket fail the next send.
+        sender.send(metrics)
+        sender.send(metrics)
+
+    @mock.patch('shumway._sendmmsg', None)
+    def test_send_many_datagrams_without_sendmmsg(self):
+        sender = shumway._UDPSender(*self.receiver.getsockname())
+        metrics = {}
+        for name in ('foo', 'bar'):
+            metrics[name] = shumway.Counter(name, 'key', value=1)
+
+        sender.send(metrics)
+
+        self.assertEqual([m.to_bytes() for m in metrics.values()],
+                         self._receive(len(metrics)))
+
+
+class AsyncSenderTest(unittest2.TestCase):
+    def setUp(self):
+        self.sender = mock.Mock()
+        self.sending = threading.Event()
+        self.release = threading.Event()
+
+        def block(metric):
+            self.sending.set()
+            self.release.wait(1)
+
+        self.sender.send_single.side_effect = block
+
+    def test_drops_oldest_when_full(self):
+        async_sender = shumway._AsyncSender(self.sender, 2)
+        async_sender.send_single('first')
+        self.sending.wait(1)
+        for metric in ('second', 'third', 'fourth', 'fifth'):
+            async_sender.send_single(metric)
+        self.release.set()
+        async_sender.close()
+
+        self.assertEqual(2, async_sender.dropped)
+        self.assertEqual(
+            [mock.call('first'), mock.call('fourth'), mock.call('fifth')],
+            self.sender.send_single.call_args_list)
+        self.sender.close.assert_called_once_with()
+
+    def test_close_sends_items_queued_after_last_empty_pop(self):
+        sender = mock.Mock()
+        async_sender = shumway._AsyncSender(sender, 10)
+        paused = threading.Event()
+        resume = threading.Event()
+        pop = async_sender._pop
+
+        def pause_after_empty_pop():
+            item = pop()
+            if item is None and not paused.is_set():
+                paused.set()
+                resume.wait(1)
+            return item
+
+        async_sender._pop = pause_after_empty_pop
+        async_sender.send_single('first')
+        self.assertTrue(paused.wait(1))
+
+        # The consumer has found the queue empty but not yet checked for
+        # close(); a send accepted now must still go out.
+        async_sender.send_single('late')
+        closer = threading.Thread(target=async_sender.close)
+        closer.start()
+        for _ in range(100):
+            if async_sender._closed:
+                break
+            closer.join(0.01)
+        resume.set()
+        closer.join(1)
+
+        self.assertFalse(closer.is_alive())
+        self.assertEqual([mock.call('first'), mock.call('late')],
+                         sender.send_single.call_args_list)
+        sender.close.assert_called_once_with()
+
+    def test_rejects_sends_after_close(self):
+        async_sender = shumway._AsyncSender(self.sender, 10)
+        async_sender.close()
+
+        with self.assertRaises(RuntimeError):
+            async_sender.send_single('late')
+        with self.assertRaises(RuntimeError):
+            async_sender.send({'late': 1})
+        self.sender.send_single.assert_not_called()
+        self.sender.send.assert_not_called()
+
+    def test_keeps_sending_after_error(self):
+        self.sender.send.side_effect = [Exception('boom'), None]
+        async_sender = shumway._AsyncSender(self.sender, 10)
+        async_sender.send({'foo': 1})
+        async_sender.send({'bar': 2})
+        async_sender.close()
+
+        self.assertEqual([mock.call({'foo': 1}), mock.call({'bar': 2})],
+                         self.sender.send.call_args_list)
+
+    def test_send_copies_metrics(self):
+        metrics = {'foo': 1}
+        async_sender = shumway._AsyncSender(self.sender, 10)
+        async_sender.send(metrics)
+        async_sender.close()
+
+        sent = self.sender.send.call_args[0][0]
+        self.assertEqual(metrics, sent)
+        self.assertIsNot(metrics, sent)